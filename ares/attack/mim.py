@@ -1,8 +1,10 @@
+import contextlib
+
 import tensorflow as tf
 import numpy as np
 
 from ares.attack.base import BatchAttack
-from ares.attack.utils import get_xs_ph, get_ys_ph, maybe_to_array, get_unit
+from ares.attack.utils import get_xs_ph, get_ys_ph
 
 
 class MIM(BatchAttack):
@@ -14,7 +16,8 @@ class MIM(BatchAttack):
     - References: https://arxiv.org/abs/1710.06081.
     '''
 
-    def __init__(self, model, batch_size, loss, goal, distance_metric, session, iteration_callback=None):
+    def __init__(self, model, batch_size, loss, goal, distance_metric, session, iteration_callback=None,
+                 use_while_loop=False, unrolled_iteration=None, use_low_precision=False, device=None):
         ''' Initialize MIM.
 
         :param model: The model to attack. A ``ares.model.Classifier`` instance.
@@ -27,79 +30,224 @@ class MIM(BatchAttack):
             ``tf.Tensor`` (the adversarial examples for ``xs``). During ``batch_attack()``, this callback function would
             be runned after each iteration, and its return value would be yielded back to the caller. By default,
             ``iteration_callback`` is ``None``.
+        :param use_while_loop: A bool. Whether to run all iterations inside one ``tf.while_loop`` in a single
+            ``session.run()`` call, instead of one ``session.run()`` call per iteration. Requires the
+            ``iteration_callback`` to be ``None``. Losses and models which feed their own placeholders inside the
+            graph, e.g. ``EnsembleRandomnessCrossEntropyLoss``, or which create graph state like variables on their
+            first call, do not work inside a ``tf.while_loop``. When it is ``True``, the ``loss`` tensor, ``g_var``,
+            ``setup_g`` and ``update_step`` are not built. By default, ``use_while_loop`` is ``False``.
+        :param unrolled_iteration: An integer. When the ``iteration_callback`` is ``None``, also build a graph with this
+            many iterations unrolled, which is used instead of the ``tf.while_loop`` or the per-iteration updates when
+            the configured iteration count equals it. Since the model is copied into the graph once per iteration, it
+            should be small. By default, ``unrolled_iteration`` is ``None``.
+        :param use_low_precision: A bool. Whether to store the adversarial example in ``tf.float16`` and add each step
+            to it in ``tf.float16``, which halves the memory of the stored adversarial example. Only supported for the
+            ``'l_inf'`` distance metric, since ``tf.float16`` rounds away small ``l_2`` steps. The momentum term, the
+            gradient, the original example and the magnitude bounds stay in the model's ``x_dtype``, and adversarial
+            examples are projected into the bounds in ``x_dtype``. By default, ``use_low_precision`` is ``False``.
+        :param device: A device name like ``'/GPU:0'``. If not ``None``, the attack's variables and its update ops,
+            including the model's forward and backward pass inside the update, are placed on this device. The model
+            should support running on it, or the session should allow soft placement. Placeholders and the
+            ``tf.data`` iterator are left to the default placement. By default, ``device`` is ``None``.
         '''
         self.model, self.batch_size, self._session = model, batch_size, session
         self.loss, self.goal, self.distance_metric = loss, goal, distance_metric
+        self.use_while_loop, self.unrolled_iteration = use_while_loop, unrolled_iteration
         # placeholder for batch_attack's input
         self.xs_ph = get_xs_ph(model, batch_size)
         self.ys_ph = get_ys_ph(model, batch_size)
-        # flatten shape of xs_ph
-        xs_flatten_shape = (batch_size, np.prod(self.model.x_shape))
-        # store xs and ys in variables to reduce memory copy between tensorflow and python
-        # variable for the original example with shape of (batch_size, D)
-        self.xs_var = tf.Variable(tf.zeros(shape=xs_flatten_shape, dtype=self.model.x_dtype))
-        # variable for labels
-        self.ys_var = tf.Variable(tf.zeros(shape=(batch_size,), dtype=self.model.y_dtype))
-        # variable for the (hopefully) adversarial example with shape of (batch_size, D)
-        self.xs_adv_var = tf.Variable(tf.zeros(shape=xs_flatten_shape, dtype=self.model.x_dtype))
-        # variable for the momentum term
-        self.g_var = tf.Variable(tf.zeros(shape=xs_flatten_shape, dtype=self.model.x_dtype))
-        # decay factor
+        # keep examples in the model's input shape, so that no reshape is needed inside iterations
+        xs_shape = (batch_size, *self.model.x_shape)
+        # axes of one example, for per-example reductions
+        xs_axes = list(range(1, len(xs_shape)))
+        # data type for the stored adversarial example
+        x_dtype = self.model.x_dtype
+        dtype = tf.float16 if use_low_precision else x_dtype
+        # placeholders for config()'s input
         self.decay_factor_ph = tf.placeholder(self.model.x_dtype, ())
-        self.decay_factor_var = tf.Variable(tf.zeros(shape=(), dtype=self.model.x_dtype))
-        # magnitude
-        self.eps_ph = tf.placeholder(self.model.x_dtype, (self.batch_size,))
-        self.eps_var = tf.Variable(tf.zeros((self.batch_size,), dtype=self.model.x_dtype))
-        # step size
-        self.alpha_ph = tf.placeholder(self.model.x_dtype, (self.batch_size,))
-        self.alpha_var = tf.Variable(tf.zeros((self.batch_size,), dtype=self.model.x_dtype))
-        # expand dim for easier broadcast operations
-        eps = tf.expand_dims(self.eps_var, 1)
-        alpha = tf.expand_dims(self.alpha_var, 1)
-        # calculate loss' gradient with relate to the adversarial example
-        # grad.shape == (batch_size, D)
-        self.xs_adv_model = tf.reshape(self.xs_adv_var, (batch_size, *self.model.x_shape))
-        self.loss = loss(self.xs_adv_model, self.ys_var)
-        grad = tf.gradients(self.loss, self.xs_adv_var)[0]
-        if goal == 't' or goal == 'tm':
-            grad = -grad
-        elif goal != 'ut':
+        # magnitude and step size placeholders accept either a scalar or a (batch_size,) array
+        self.eps_ph = tf.placeholder(self.model.x_dtype, None)
+        self.alpha_ph = tf.placeholder(self.model.x_dtype, None)
+
+        def on_device():
+            ''' Scope for the attack's variables and update ops, see the ``device`` parameter. '''
+            # contextlib.ExitStack() is a no-op context manager, which is available since python 3.3
+            return tf.device(device) if device is not None else contextlib.ExitStack()
+
+        with on_device():
+            # store xs and ys in variables to reduce memory copy between tensorflow and python
+            # variable for the original example with shape of (batch_size, *x_shape)
+            self.xs_var = tf.Variable(tf.zeros(shape=xs_shape, dtype=x_dtype))
+            # variable for labels
+            self.ys_var = tf.Variable(tf.zeros(shape=(batch_size,), dtype=self.model.y_dtype))
+            # variable for the (hopefully) adversarial example with shape of (batch_size, *x_shape)
+            self.xs_adv_var = tf.Variable(tf.zeros(shape=xs_shape, dtype=dtype))
+            # decay factor
+            self.decay_factor_var = tf.Variable(tf.zeros(shape=(), dtype=self.model.x_dtype))
+            # magnitude
+            self.eps_var = tf.Variable(tf.zeros((self.batch_size,), dtype=self.model.x_dtype))
+            # step size
+            self.alpha_var = tf.Variable(tf.zeros((self.batch_size,), dtype=self.model.x_dtype))
+            # expand dims for easier broadcast operations
+            eps = tf.reshape(self.eps_var, (batch_size, *[1] * len(xs_axes)))
+            alpha = tf.cast(tf.reshape(self.alpha_var, (batch_size, *[1] * len(xs_axes))), dtype)
+            if distance_metric == 'l_inf':
+                # lower and upper bound for the adversarial example, which stay the same across iterations
+                self.xs_lo_var = tf.Variable(tf.zeros(shape=xs_shape, dtype=x_dtype))
+                self.xs_hi_var = tf.Variable(tf.zeros(shape=xs_shape, dtype=x_dtype))
+        if goal not in ('t', 'tm', 'ut'):
             raise NotImplementedError
-        # 1-norm of gradient
-        grad_l1 = tf.reduce_sum(tf.abs(grad), axis=1)
-        # update the momentum term
-        g_next = self.decay_factor_var * self.g_var + grad / tf.expand_dims(grad_l1, 1)
-        self.update_g_step = self.g_var.assign(g_next)
-        # update the adversarial example
-        if distance_metric == 'l_2':
-            g_unit = get_unit(self.g_var)
-            xs_adv_delta = self.xs_adv_var - self.xs_var + alpha * g_unit
-            # clip by max l_2 magnitude of adversarial noise
-            xs_adv_next = self.xs_var + tf.clip_by_norm(xs_adv_delta, eps, axes=[1])
-        elif distance_metric == 'l_inf':
-            xs_lo, xs_hi = self.xs_var - eps, self.xs_var + eps
-            g_sign = tf.sign(self.g_var)
-            # clip by max l_inf magnitude of adversarial noise
-            xs_adv_next = tf.clip_by_value(self.xs_adv_var + alpha * g_sign, xs_lo, xs_hi)
-        else:
+        if distance_metric not in ('l_2', 'l_inf'):
             raise NotImplementedError
-        # clip by (x_min, x_max)
-        xs_adv_next = tf.clip_by_value(xs_adv_next, self.model.x_min, self.model.x_max)
-        self.update_xs_adv_step = self.xs_adv_var.assign(xs_adv_next)
+        if use_low_precision and distance_metric != 'l_inf':
+            raise ValueError('use_low_precision is only supported for the l_inf distance metric')
+        if use_while_loop and iteration_callback is not None:
+            raise ValueError('use_while_loop requires iteration_callback to be None')
+
+        def project(xs_adv):
+            ''' Project ``x_dtype`` adversarial examples into the magnitude bound around the original examples and
+            into the model's input range.
+            '''
+            if distance_metric == 'l_2':
+                # clip by max l_2 magnitude of adversarial noise, as tf.clip_by_norm() in one fusible expression
+                xs_adv_delta = xs_adv - self.xs_var
+                xs_adv_delta_l2_sq = tf.reduce_sum(tf.square(xs_adv_delta), axis=xs_axes, keepdims=True)
+                xs_adv_delta_scale = tf.minimum(1.0, eps * tf.math.rsqrt(xs_adv_delta_l2_sq + 1e-12))
+                xs_adv = self.xs_var + xs_adv_delta * xs_adv_delta_scale
+            else:
+                # clip by max l_inf magnitude of adversarial noise
+                xs_adv = tf.clip_by_value(xs_adv, self.xs_lo_var, self.xs_hi_var)
+            # clip by (x_min, x_max)
+            return tf.clip_by_value(xs_adv, self.model.x_min, self.model.x_max)
+
+        def to_model(xs_adv):
+            ''' Cast adversarial examples to ``x_dtype``. In low precision, project them again, since rounding them to
+            ``tf.float16`` could move them slightly out of the bounds.
+            '''
+            xs_adv = tf.cast(xs_adv, x_dtype)
+            return project(xs_adv) if use_low_precision else xs_adv
+
+        def update(g, xs_adv):
+            ''' One iteration of MIM. Return the loss on the adversarial example, the next momentum term and the next
+            adversarial example.
+            '''
+            # calculate loss' gradient with relate to the adversarial example
+            # grad.shape == (batch_size, *x_shape)
+            xs_adv_model = tf.cast(xs_adv, x_dtype)
+            xs_adv_loss = loss(xs_adv_model, self.ys_var)
+            # for targeted goals, negate the per-example loss instead of the much larger gradient tensor
+            xs_adv_objective = xs_adv_loss
+            if goal == 't' or goal == 'tm':
+                xs_adv_objective = -xs_adv_loss
+            # nothing differentiates through the update, so cut the gradient off from any further backward pass
+            grad = tf.stop_gradient(tf.gradients(xs_adv_objective, xs_adv_model)[0])
+            # reciprocal of gradient's 1-norm, so that the normalization is a broadcast multiply
+            grad_l1_inv = tf.math.reciprocal(tf.reduce_sum(tf.abs(grad), axis=xs_axes, keepdims=True) + 1e-12)
+            # update the momentum term, which stays in x_dtype, since it accumulates over iterations
+            g_next = self.decay_factor_var * g + grad * grad_l1_inv
+            # update the adversarial example with the new momentum term
+            if distance_metric == 'l_2':
+                g_l2_sq = tf.reduce_sum(tf.square(g_next), axis=xs_axes, keepdims=True)
+                g_unit = g_next * tf.math.rsqrt(g_l2_sq + 1e-12)
+                xs_adv_next = xs_adv + alpha * g_unit
+            else:
+                # tf.sign() is exact in a low precision dtype
+                g_sign = tf.cast(tf.sign(g_next), dtype)
+                xs_adv_next = xs_adv + alpha * g_sign
+            # project in x_dtype, so that the bounds are not rounded to a low precision dtype
+            xs_adv_next = tf.cast(project(tf.cast(xs_adv_next, x_dtype)), dtype)
+            return xs_adv_loss, g_next, xs_adv_next
+
+        self.xs_adv_model = to_model(self.xs_adv_var)
+        if use_while_loop:
+            self.iteration_ph = tf.placeholder(tf.int32, ())
+        with on_device():
+            if use_while_loop:
+                # run all iterations inside one tf.while_loop, so that the attack is done in one session.run() call
+                _, _, xs_adv_final = tf.while_loop(
+                    lambda i, _g, _xs_adv: i < self.iteration_ph,
+                    lambda i, g, xs_adv: (i + 1, *update(g, xs_adv)[1:]),
+                    (tf.constant(0), tf.zeros(xs_shape, dtype=x_dtype), tf.cast(self.xs_var.value(), dtype)),
+                    back_prop=False,
+                )
+                self.run_attack = self.xs_adv_var.assign(xs_adv_final)
+                xs_adv_final = to_model(xs_adv_final)
+                # fetch the result in the same session.run() call as the attack
+                with tf.control_dependencies([self.run_attack]):
+                    self.xs_adv_final = tf.identity(xs_adv_final)
+            else:
+                # variable for the momentum term
+                self.g_var = tf.Variable(tf.zeros(shape=xs_shape, dtype=x_dtype))
+                self.setup_g = self.g_var.assign(tf.zeros(shape=xs_shape, dtype=x_dtype))
+                self.loss, g_next, xs_adv_next = update(self.g_var, self.xs_adv_var)
+                # compute both updates before assigning any of them, so that they could be done in one session.run()
+                with tf.control_dependencies([g_next, xs_adv_next]):
+                    self.update_step = tf.group(self.g_var.assign(g_next), self.xs_adv_var.assign(xs_adv_next))
+            if iteration_callback is None and unrolled_iteration is not None:
+                # specialize the attack for a known iteration count by chaining the iterations in the graph
+                g, xs_adv_unrolled = tf.zeros(xs_shape, dtype=x_dtype), tf.cast(self.xs_var.value(), dtype)
+                for _ in range(unrolled_iteration):
+                    _, g, xs_adv_unrolled = update(g, xs_adv_unrolled)
+                self.run_attack_unrolled = self.xs_adv_var.assign(xs_adv_unrolled)
+                xs_adv_unrolled = to_model(xs_adv_unrolled)
+                with tf.control_dependencies([self.run_attack_unrolled]):
+                    self.xs_adv_final_unrolled = tf.identity(xs_adv_unrolled)
 
-        self.config_eps_step = self.eps_var.assign(self.eps_ph)
-        self.config_alpha_step = self.alpha_var.assign(self.alpha_ph)
+        # broadcast scalars on the device instead of repeating them into a numpy array
+        self.config_eps_step = self.eps_var.assign(tf.broadcast_to(self.eps_ph, (self.batch_size,)))
+        self.config_alpha_step = self.alpha_var.assign(tf.broadcast_to(self.alpha_ph, (self.batch_size,)))
         self.config_decay_factor_step = self.decay_factor_var.assign(self.decay_factor_ph)
-        self.setup_xs = [self.xs_var.assign(tf.reshape(self.xs_ph, xs_flatten_shape)),
-                         self.xs_adv_var.assign(tf.reshape(self.xs_ph, xs_flatten_shape))]
+
+        def setup_xs(xs):
+            ''' Initialize both the original and the adversarial example from the same ``xs`` tensor. '''
+            ops = [self.xs_var.assign(xs), self.xs_adv_var.assign(tf.cast(xs, dtype))]
+            if distance_metric == 'l_inf':
+                ops += [self.xs_lo_var.assign(xs - eps), self.xs_hi_var.assign(xs + eps)]
+            return ops
+
+        self.setup_xs = setup_xs(self.xs_ph)
         self.setup_ys = self.ys_var.assign(self.ys_ph)
-        self.setup_g = tf.variables_initializer([self.g_var])
+        if iteration_callback is None:
+            # iterator for attack_dataset(), which loads batches into the variables without copying through python
+            self._dataset_iterator = tf.data.Iterator.from_structure(
+                (self.model.x_dtype, self.model.y_dtype), (tf.TensorShape(xs_shape), tf.TensorShape((batch_size,))))
+            xs_next, ys_next = self._dataset_iterator.get_next()
+            self.setup_next = setup_xs(xs_next) + [self.ys_var.assign(ys_next)]
+        # setup the whole batch in one session.run() call, the momentum term is only stored in g_var when iterations
+        # are runned one by one
+        if use_while_loop:
+            self.setup_all = tf.group(*self.setup_xs, self.setup_ys)
+        else:
+            self.setup_all = tf.group(*self.setup_xs, self.setup_ys, self.setup_g)
+            if iteration_callback is None:
+                self.setup_next.append(self.setup_g)
         self.iteration = None
 
         self.iteration_callback = None
         if iteration_callback is not None:
-            xs_model = tf.reshape(self.xs_var, (self.batch_size, *self.model.x_shape))
-            self.iteration_callback = iteration_callback(xs_model, self.xs_adv_model)
+            self.iteration_callback = iteration_callback(self.xs_var.value(), self.xs_adv_model)
+
+        # specialize session calls for batch_attack()'s fixed feeds and fetches, so that they are prepared only once
+        self._setup_all_fn = session.make_callable(self.setup_all, feed_list=[self.xs_ph, self.ys_ph])
+        if use_while_loop:
+            self._attack_fn = session.make_callable(self.xs_adv_final, feed_list=[self.iteration_ph])
+        else:
+            self._update_fn = session.make_callable(self.update_step)
+        if self.iteration_callback is None:
+            if unrolled_iteration is not None:
+                self._attack_unrolled_fn = session.make_callable(self.xs_adv_final_unrolled)
+            self._setup_next_fn = session.make_callable(self.setup_next)
+
+    def xs_adv_labels(self):
+        ''' Get the model's predicted labels on the current adversarial examples, so that they could be evaluated
+        without feeding them back. The model's graph for them is built in the first call instead of in ``__init__()``,
+        so that attacks which never evaluate their labels do not pay for an extra forward pass in the graph. It is safe
+        to call this method many times, since ``ares.model.Classifier.labels()`` caches the graph for each input
+        tensor, so that later calls return the same tensor without creating new graph nodes.
+
+        :return: A ``tf.Tensor`` of the predicted labels, with shape ``(self.batch_size,)``.
+        '''
+        return self.model.labels(self.xs_adv_model)
 
     def config(self, **kwargs):
         ''' (Re)config the attack.
@@ -112,29 +260,83 @@ class MIM(BatchAttack):
         :param iteration: An integer, the iteration count.
         '''
         if 'magnitude' in kwargs:
-            eps = maybe_to_array(kwargs['magnitude'], self.batch_size)
-            self._session.run(self.config_eps_step, feed_dict={self.eps_ph: eps})
+            self._session.run(self.config_eps_step, feed_dict={self.eps_ph: kwargs['magnitude']})
         if 'alpha' in kwargs:
-            alpha = maybe_to_array(kwargs['alpha'], self.batch_size)
-            self._session.run(self.config_alpha_step, feed_dict={self.alpha_ph: alpha})
+            self._session.run(self.config_alpha_step, feed_dict={self.alpha_ph: kwargs['alpha']})
         if 'decay_factor' in kwargs:
             decay_factor = kwargs['decay_factor']
             self._session.run(self.config_decay_factor_step, feed_dict={self.decay_factor_ph: decay_factor})
         if 'iteration' in kwargs:
             self.iteration = kwargs['iteration']
 
+    def _run_attack(self):
+        ''' Run all iterations on the current batch and return the adversarial examples. '''
+        if self.unrolled_iteration is not None and self.iteration == self.unrolled_iteration:
+            return self._attack_unrolled_fn()
+        if self.use_while_loop:
+            return self._attack_fn(self.iteration)
+        for _ in range(self.iteration):
+            self._update_fn()
+        return self._session.run(self.xs_adv_model)
+
     def _batch_attack_generator(self, xs, ys, ys_target):
         labels = ys if self.goal == 'ut' else ys_target
-        self._session.run(self.setup_xs, feed_dict={self.xs_ph: xs})
-        self._session.run(self.setup_ys, feed_dict={self.ys_ph: labels})
-        self._session.run(self.setup_g)
+        self._setup_all_fn(xs, labels)
+        if self.iteration_callback is None:
+            return self._run_attack()
         for _ in range(self.iteration):
-            self._session.run(self.update_g_step)
-            self._session.run(self.update_xs_adv_step)
-            if self.iteration_callback is not None:
-                yield self._session.run(self.iteration_callback)
+            self._update_fn()
+            yield self._session.run(self.iteration_callback)
         return self._session.run(self.xs_adv_model)
 
+    def dataset_initializer(self, dataset):
+        ''' Build an initializer, which loads a dataset into the iterator of ``attack_dataset()``. Each call creates new
+        graph nodes, so keep the returned initializer and pass it to ``attack_dataset()`` to attack the same dataset
+        more than once. Only available when the ``iteration_callback`` is ``None``.
+
+        :param dataset: A ``tf.data.Dataset`` instance, whose elements are tuples of a batch of examples and a batch of
+            labels. The batch dimension should be statically known to be ``self.batch_size``, e.g. by batching it with
+            ``dataset.batch(batch_size, drop_remainder=True)``. The labels should be the ground truth labels when the
+            goal is ``'ut'``, and the target labels otherwise.
+        :return: A ``tf.Operation`` instance.
+        '''
+        if self.iteration_callback is not None:
+            raise ValueError('attack_dataset() requires iteration_callback to be None, use batch_attack() instead')
+        for shape in dataset.output_shapes:
+            if shape.ndims is None or shape.ndims == 0 or shape.as_list()[0] != self.batch_size:
+                raise ValueError('the batch dimension of the dataset should be batch_size, please batch it with '
+                                 'dataset.batch(batch_size, drop_remainder=True)')
+        # load the next batch while attacking the current one
+        return self._dataset_iterator.make_initializer(dataset.prefetch(1))
+
+    def attack_dataset(self, dataset):
+        ''' Attack all batches of a dataset. Each batch is loaded into the attack's variables by an iterator inside the
+        graph, so that examples are not copied through python. Only available when the ``iteration_callback`` is
+        ``None``.
+
+        :param dataset: Either a ``tf.data.Dataset`` instance as described in ``dataset_initializer()``, or an
+            initializer returned by ``dataset_initializer()``. Passing a dataset builds a new initializer in each call,
+            so pass an initializer instead to attack the same dataset more than once.
+        :return: The generated adversarial examples for all batches, concatenated into one numpy array. If the dataset
+            is empty, the array's shape is ``(0, *self.model.x_shape)``.
+        '''
+        if self.iteration_callback is not None:
+            raise ValueError('attack_dataset() requires iteration_callback to be None, use batch_attack() instead')
+        if isinstance(dataset, tf.Operation):
+            self._session.run(dataset)
+        else:
+            self._session.run(self.dataset_initializer(dataset))
+        xs_adv = []
+        while True:
+            try:
+                self._setup_next_fn()
+            except tf.errors.OutOfRangeError:
+                break
+            xs_adv.append(self._run_attack())
+        if len(xs_adv) == 0:
+            return np.zeros((0, *self.model.x_shape), dtype=self.model.x_dtype.as_numpy_dtype)
+        return np.concatenate(xs_adv)
+
     def batch_attack(self, xs, ys=None, ys_target=None):
         ''' Attack a batch of examples.
 
@@ -56,14 +56,133 @@ for lo in range(0, batch_size, batch_size):
     except StopIteration as e:
         xs_adv = e.value
 
-    lbs_pred = session.run(lbs, feed_dict={xs_ph: xs})
-    lbs_adv = session.run(lbs, feed_dict={xs_ph: xs_adv})
+    lbs_pred, lbs_adv = session.run((lbs, attack.xs_adv_labels()), feed_dict={xs_ph: xs})
 
     print(
         np.equal(ys, lbs_pred).astype(np.float).mean(),
         np.equal(ys, lbs_adv).astype(np.float).mean()
     )
 
+# with use_while_loop, all iterations run inside one tf.while_loop, which should give the same result
+attack_loop = MIM(
+    model=model,
+    batch_size=batch_size,
+    loss=loss,
+    goal='ut',
+    distance_metric='l_inf',
+    session=session,
+    use_while_loop=True,
+)
+attack_loop.config(
+    iteration=10,
+    decay_factor=1.0,
+    magnitude=8.0 / 255.0,
+    alpha=1.0 / 255.0,
+)
+
+xs_adv_loop = attack_loop.batch_attack(xs, ys=ys)
+# the tf.while_loop should write the returned examples back into the attack's variable
+assert np.allclose(xs_adv_loop, session.run(attack_loop.xs_adv_model))
+# allow a few elements to differ, since gradients on GPU are not bit-wise deterministic
+mismatch = np.mean(np.logical_not(np.isclose(xs_adv_loop, xs_adv, atol=1e-5)))
+print(mismatch)
+assert mismatch < 1e-3
+
+# with unrolled_iteration, the 10 iterations are chained in the graph, which should give the same result. It is also
+# placed on the CPU to run the device option.
+attack_unrolled = MIM(
+    model=model,
+    batch_size=batch_size,
+    loss=loss,
+    goal='ut',
+    distance_metric='l_inf',
+    session=session,
+    unrolled_iteration=10,
+    device='/cpu:0',
+)
+attack_unrolled.config(
+    iteration=10,
+    decay_factor=1.0,
+    magnitude=8.0 / 255.0,
+    alpha=1.0 / 255.0,
+)
+
+xs_adv_unrolled = attack_unrolled.batch_attack(xs, ys=ys)
+# CPU and GPU kernels round differently, so allow a few more elements to differ
+mismatch = np.mean(np.logical_not(np.isclose(xs_adv_unrolled, xs_adv, atol=1e-5)))
+print(mismatch)
+assert mismatch < 1e-2
+
+# the l_2 distance metric, with iterations runned one by one and inside one tf.while_loop
+xs_adv_l2 = []
+for use_while_loop in (False, True):
+    attack_l2 = MIM(
+        model=model,
+        batch_size=batch_size,
+        loss=loss,
+        goal='ut',
+        distance_metric='l_2',
+        session=session,
+        use_while_loop=use_while_loop,
+    )
+    attack_l2.config(
+        iteration=10,
+        decay_factor=1.0,
+        magnitude=1.0,
+        alpha=0.1,
+    )
+    xs_adv_l2.append(attack_l2.batch_attack(xs, ys=ys))
+
+mismatch = np.mean(np.logical_not(np.isclose(xs_adv_l2[0], xs_adv_l2[1], atol=1e-5)))
+print(mismatch)
+assert mismatch < 1e-3
+# the l_2 distortion should be inside the magnitude bound
+assert np.max(np.linalg.norm((xs_adv_l2[0] - xs).reshape((batch_size, -1)), axis=1)) <= 1.0 + 1e-4
+
+# with use_low_precision, the adversarial examples should still be finite, inside the magnitude bound and inside the
+# model's input range
+attack_low = MIM(
+    model=model,
+    batch_size=batch_size,
+    loss=loss,
+    goal='ut',
+    distance_metric='l_inf',
+    session=session,
+    use_low_precision=True,
+)
+attack_low.config(
+    iteration=10,
+    decay_factor=1.0,
+    magnitude=8.0 / 255.0,
+    alpha=1.0 / 255.0,
+)
+
+xs_adv_low = attack_low.batch_attack(xs, ys=ys)
+assert np.all(np.isfinite(xs_adv_low))
+assert np.max(np.abs(xs_adv_low - xs)) <= 8.0 / 255.0 + 1e-6
+assert np.min(xs_adv_low) >= model.x_min and np.max(xs_adv_low) <= model.x_max
+
+# attack_dataset() loads batches through a tf.data iterator, which should give the same result as batch_attack()
+dataset_slices = tf.data.Dataset.from_tensor_slices((
+    xs.astype(model.x_dtype.as_numpy_dtype),
+    ys.astype(model.y_dtype.as_numpy_dtype),
+))
+dataset = dataset_slices.batch(batch_size, drop_remainder=True)
+xs_adv_dataset = attack_loop.attack_dataset(dataset)
+assert xs_adv_dataset.shape == xs_adv_loop.shape
+assert np.mean(np.logical_not(np.isclose(xs_adv_dataset, xs_adv_loop, atol=1e-5))) < 1e-3
+# a kept initializer could be reused without building new graph nodes
+dataset_initializer = attack_loop.dataset_initializer(dataset)
+assert np.allclose(attack_loop.attack_dataset(dataset_initializer), xs_adv_dataset, atol=1e-5)
+# an empty dataset gives an empty array
+assert attack_loop.attack_dataset(dataset.take(0)).shape == (0, *model.x_shape)
+# without drop_remainder, the batch dimension is not statically known
+try:
+    attack_loop.attack_dataset(dataset_slices.batch(batch_size))
+    assert False
+except ValueError:
+    pass
+
 eps = np.concatenate((np.ones(50) * 1.0 / 255.0, np.ones(50) * 8.0 / 255.0))
 attack.config(
     iteration=10,
@@ -82,8 +201,7 @@ for lo in range(0, batch_size, batch_size):
     except StopIteration as e:
         xs_adv = e.value
 
-    lbs_pred = session.run(lbs, feed_dict={xs_ph: xs})
-    lbs_adv = session.run(lbs, feed_dict={xs_ph: xs_adv})
+    lbs_pred, lbs_adv = session.run((lbs, attack.xs_adv_labels()), feed_dict={xs_ph: xs})
 
     print(
         np.equal(ys, lbs_pred).astype(np.float).mean(),